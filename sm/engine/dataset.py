@@ -3,6 +3,18 @@ import logging
 
 from sm.engine.errors import UnknownDSID
 
+try:
+    import orjson
+except ImportError:
+    json_dumps = json.dumps
+else:
+    def json_dumps(obj):
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS).decode('utf-8')
+        except TypeError:
+            # types orjson can't serialize, e.g. numpy arrays of non-native dtypes
+            return json.dumps(obj)
+
 logger = logging.getLogger('engine')
 
 
@@ -35,14 +47,19 @@ class Dataset(object):
     """ Model class for representing a dataset """
     DS_SEL = ('SELECT id, name, input_path, upload_dt, metadata, config, status, is_public, mol_dbs, adducts '
               'FROM dataset WHERE id = %s')
-    DS_UPD = ('UPDATE dataset set name=%(name)s, input_path=%(input_path)s, upload_dt=%(upload_dt)s, '
-              'metadata=%(metadata)s, config=%(config)s, status=%(status)s, is_public=%(is_public)s, '
-              'mol_dbs=%(mol_dbs)s, adducts=%(adducts)s where id=%(id)s')
     DS_CONFIG_SEL = 'SELECT config FROM dataset WHERE id = %s'
     DS_INSERT = ('INSERT INTO dataset (id, name, input_path, upload_dt, metadata, config, status, '
                  'is_public, mol_dbs, adducts) '
                  'VALUES (%(id)s, %(name)s, %(input_path)s, %(upload_dt)s, %(metadata)s, %(config)s, %(status)s, '
                  '%(is_public)s, %(mol_dbs)s, %(adducts)s)')
+    DS_UPSERT = ('INSERT INTO dataset (id, name, input_path, upload_dt, metadata, config, status, '
+                 'is_public, mol_dbs, adducts) '
+                 'VALUES (%(id)s, %(name)s, %(input_path)s, %(upload_dt)s, %(metadata)s, %(config)s, %(status)s, '
+                 '%(is_public)s, %(mol_dbs)s, %(adducts)s) '
+                 'ON CONFLICT (id) DO UPDATE SET name=EXCLUDED.name, input_path=EXCLUDED.input_path, '
+                 'upload_dt=EXCLUDED.upload_dt, metadata=EXCLUDED.metadata, config=EXCLUDED.config, '
+                 'status=EXCLUDED.status, is_public=EXCLUDED.is_public, mol_dbs=EXCLUDED.mol_dbs, '
+                 'adducts=EXCLUDED.adducts')
 
     ACQ_GEOMETRY_SEL = 'SELECT acq_geometry FROM dataset WHERE id = %s'
     ACQ_GEOMETRY_UPD = 'UPDATE dataset SET acq_geometry = %s WHERE id = %s'
@@ -87,6 +104,8 @@ class Dataset(object):
         return self.__dict__ == other.__dict__
 
     def set_status(self, db, es, status_queue=None, status=None):
+        if status == self.status:
+            return
         self.status = status
         self.save(db, es, status_queue)
 
@@ -99,10 +118,6 @@ class Dataset(object):
         else:
             raise UnknownDSID('Dataset does not exist: {}'.format(ds_id))
 
-    def is_stored(self, db):
-        r = db.select_one(self.DS_SEL, params=(self.id,))
-        return True if r else False
-
     def save(self, db, es, status_queue=None):
         assert self.id and self.name and self.input_path and self.upload_dt and self.config and self.status \
                and self.is_public is not None
@@ -111,18 +126,15 @@ class Dataset(object):
             'name': self.name,
             'input_path': self.input_path,
             'upload_dt': self.upload_dt,
-            'metadata': json.dumps(self.metadata),
-            'config': json.dumps(self.config),
+            'metadata': json_dumps(self.metadata),
+            'config': json_dumps(self.config),
             'status': self.status,
             'is_public': self.is_public,
             'mol_dbs': self.mol_dbs,
             'adducts': self.adducts
         }
-        if not self.is_stored(db):
-            db.insert(self.DS_INSERT, rows=[doc])
-        else:
-            db.alter(self.DS_UPD, params=doc)
-        logger.info("Inserted into dataset table: %s, %s", self.id, self.name)
+        db.insert(self.DS_UPSERT, rows=[doc])
+        logger.info("Upserted into dataset table: %s, %s", self.id, self.name)
 
         es.sync_dataset(self.id)
         if status_queue:
@@ -135,7 +147,7 @@ class Dataset(object):
         return r[0]
 
     def save_acq_geometry(self, db, acq_geometry):
-        db.alter(self.ACQ_GEOMETRY_UPD, params=(json.dumps(acq_geometry), self.id))
+        db.alter(self.ACQ_GEOMETRY_UPD, params=(json_dumps(acq_geometry), self.id))
 
     def get_ion_img_storage_type(self, db):
         if not self.ion_img_storage_type:
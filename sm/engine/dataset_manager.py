@@ -1,7 +1,7 @@
 import io
+from concurrent.futures import ThreadPoolExecutor
 import logging
 import requests
-import numpy as np
 from PIL import Image
 
 from sm.engine.dataset import DatasetStatus, Dataset
@@ -17,6 +17,8 @@ SEL_DATASET_RAW_OPTICAL_IMAGE = 'SELECT optical_image from dataset WHERE id = %s
 UPD_DATASET_RAW_OPTICAL_IMAGE = 'update dataset set optical_image = %s, transform = %s WHERE id = %s'
 DEL_DATASET_RAW_OPTICAL_IMAGE = 'update dataset set optical_image = NULL, transform = NULL WHERE id = %s'
 UPD_DATASET_THUMB_OPTICAL_IMAGE = 'update dataset set thumbnail = %s WHERE id = %s'
+SEL_DATASET_EDITABLE_FIELDS = ('SELECT name, input_path, upload_dt, metadata, config, is_public, status '
+                               'FROM dataset WHERE id = %s')
 
 IMG_URLS_BY_ID_SEL = ('SELECT iso_image_ids '
                       'FROM iso_image_metrics m '
@@ -24,10 +26,13 @@ IMG_URLS_BY_ID_SEL = ('SELECT iso_image_ids '
                       'JOIN dataset d ON d.id = j.ds_id '
                       'WHERE ds_id = %s')
 
+DEL_IMG_BATCH_SIZE = 500
+
 INS_OPTICAL_IMAGE = 'INSERT INTO optical_image (id, ds_id, zoom) VALUES (%s, %s, %s)'
 SEL_OPTICAL_IMAGE = 'SELECT id FROM optical_image WHERE ds_id = %s'
 SEL_OPTICAL_IMAGE_THUMBNAIL = 'SELECT thumbnail FROM dataset WHERE id = %s'
 DEL_OPTICAL_IMAGE = 'DELETE FROM optical_image WHERE ds_id = %s'
+DEL_OPTICAL_IMAGE_RETURNING_ID = 'DELETE FROM optical_image WHERE ds_id = %s RETURNING id'
 
 
 class DatasetAction(object):
@@ -119,9 +124,13 @@ class SMDaemonDatasetManager(DatasetManager):
         search_job_factory(img_store=self._img_store).run(ds)
 
     def _finished_job_moldbs(self, ds_id):
+        rows = self._db.select('SELECT id, db_id FROM job WHERE ds_id = %s', params=(ds_id,))
+        if not rows:
+            return []
         moldb_service = MolDBServiceWrapper(self._sm_config['services']['mol_db'])
-        for job_id, mol_db_id in self._db.select('SELECT id, db_id FROM job WHERE ds_id = %s', params=(ds_id,)):
-            yield job_id, moldb_service.find_db_by_id(mol_db_id)['name']
+        mol_db_ids = {mol_db_id for _, mol_db_id in rows}
+        mol_db_names = {d['id']: d['name'] for d in moldb_service.find_dbs_by_ids(mol_db_ids)}
+        return [(job_id, mol_db_names[mol_db_id]) for job_id, mol_db_id in rows]
 
     def update(self, ds, **kwargs):
         """ Reindex all dataset results """
@@ -145,11 +154,14 @@ class SMDaemonDatasetManager(DatasetManager):
 
         try:
             storage_type = ds.get_ion_img_storage_type(self._db)
-            for row in self._db.select(IMG_URLS_BY_ID_SEL, params=(ds.id,)):
-                iso_image_ids = row[0]
-                for img_id in iso_image_ids:
-                    if img_id:
-                        self._img_store.delete_image_by_id(storage_type, 'iso_image', img_id)
+            img_ids = []
+            for row in self._db.select_iter(IMG_URLS_BY_ID_SEL, params=(ds.id,)):
+                img_ids.extend(img_id for img_id in row[0] if img_id)
+                while len(img_ids) >= DEL_IMG_BATCH_SIZE:
+                    self._img_store.delete_images_by_ids(storage_type, 'iso_image', img_ids[:DEL_IMG_BATCH_SIZE])
+                    img_ids = img_ids[DEL_IMG_BATCH_SIZE:]
+            if img_ids:
+                self._img_store.delete_images_by_ids(storage_type, 'iso_image', img_ids)
         except UnknownDSID:
             self.logger.warning('Attempt to delete isotopic images of non-existing dataset. Skipping')
 
@@ -176,7 +188,9 @@ class SMapiDatasetManager(DatasetManager):
         self._action_queue = action_queue
 
     def _post_sm_msg(self, ds, action, priority=DatasetActionPriority.DEFAULT, **kwargs):
-        ds.set_status(self._db, self._es, self._status_queue, DatasetStatus.QUEUED)
+        # always save, the dataset fields may have changed even if it is already queued
+        ds.status = DatasetStatus.QUEUED
+        ds.save(self._db, self._es, self._status_queue)
         if self.mode == 'queue':
             msg = ds.to_queue_message()
             msg['action'] = action
@@ -193,8 +207,19 @@ class SMapiDatasetManager(DatasetManager):
         """ Send delete message to the queue """
         self._post_sm_msg(ds=ds, action=DatasetAction.DELETE, priority=DatasetActionPriority.HIGH)
 
+    def _ds_changed(self, ds):
+        row = self._db.select_one(SEL_DATASET_EDITABLE_FIELDS, params=(ds.id,))
+        if not row or row[-1] != DatasetStatus.FINISHED:
+            # a failed or interrupted reindexing has to be retriable with the same fields
+            return True
+        return tuple(row[:-1]) != (ds.name, ds.input_path, ds.upload_dt,
+                                   ds.metadata, ds.config, ds.is_public)
+
     def update(self, ds, priority=DatasetActionPriority.DEFAULT):
-        """ Send update message to the queue """
+        """ Send update message to the queue unless the dataset is stored as finished and unchanged """
+        if not self._ds_changed(ds):
+            self.logger.info('Dataset "%s" has not changed. Skipping update', ds.id)
+            return
         self._post_sm_msg(ds=ds, action=DatasetAction.UPDATE, priority=DatasetActionPriority.HIGH)
 
     def _annotation_image_shape(self, ds):
@@ -205,7 +230,8 @@ class SMapiDatasetManager(DatasetManager):
         self.logger.info('Annotation image shape for "{}" dataset is {}'.format(ds.id, result))
         return result
 
-    def _transform_scan(self, scan, transform_, dims, zoom):
+    @staticmethod
+    def _viewport_zoom(dims, zoom):
         # zoom is relative to the web application viewport size and not to the ion image dimensions,
         # i.e. zoom = 1 is what the user sees by default, and zooming into the image triggers
         # fetching higher-resolution images from the server
@@ -214,13 +240,18 @@ class SMapiDatasetManager(DatasetManager):
         VIEWPORT_WIDTH = 1000.0
         VIEWPORT_HEIGHT = 500.0
 
-        zoom = int(round(zoom * min(VIEWPORT_WIDTH / dims[0], VIEWPORT_HEIGHT / dims[1])))
+        return int(round(zoom * min(VIEWPORT_WIDTH / dims[0], VIEWPORT_HEIGHT / dims[1])))
 
-        transform = np.array(transform_)
-        assert transform.shape == (3, 3)
-        transform = transform / transform[2, 2]
-        transform[:, :2] /= zoom
-        coeffs = transform.flat[:8]
+    def _transform_scan(self, scan, transform_, dims, zoom):
+        zoom = self._viewport_zoom(dims, zoom)
+
+        assert len(transform_) == 3 and all(len(row) == 3 for row in transform_)
+        (a, b, c), (d, e, f), (g, h, i) = transform_
+        # normalize by the bottom right element and scale the first two columns by the zoom
+        s = 1.0 / (i * zoom)
+        coeffs = (a * s, b * s, c / i,
+                  d * s, e * s, f / i,
+                  g * s, h * s)
         return scan.transform((dims[0] * zoom, dims[1] * zoom),
                               Image.PERSPECTIVE, coeffs, Image.BICUBIC)
 
@@ -231,34 +262,42 @@ class SMapiDatasetManager(DatasetManager):
         return buf
 
     def _add_raw_optical_image(self, ds, img_id, transform):
+        """ Returns id of the replaced raw optical image """
         row = self._db.select_one(SEL_DATASET_RAW_OPTICAL_IMAGE, params=(ds.id,))
-        if row:
-            old_img_id = row[0]
-            if old_img_id and old_img_id != img_id:
-                self._img_store.delete_image_by_id('fs', 'raw_optical_image', old_img_id)
         self._db.alter(UPD_DATASET_RAW_OPTICAL_IMAGE, params=(img_id, transform, ds.id))
+        return row[0] if row else None
 
-    def _add_zoom_optical_images(self, ds, img_id, transform, zoom_levels):
-        dims = self._annotation_image_shape(ds)
-        rows = []
+    def _transform_optical_image(self, img_id, transform, dims, zoom):
         optical_img = self._img_store.get_image_by_id('fs', 'raw_optical_image', img_id)
-        for zoom in zoom_levels:
-            img = self._transform_scan(optical_img, transform, dims, zoom)
+        return self._transform_scan(optical_img, transform, dims, zoom)
+
+    def _post_zoom_optical_images(self, ds, transformed_img, dims, zoom_levels):
+        """ Downscale the transformed image to each of the zoom levels and post them to the image store """
+        if not zoom_levels:
+            return []
+
+        def post_zoom_image(zoom):
+            vp_zoom = self._viewport_zoom(dims, zoom)
+            size = (dims[0] * vp_zoom, dims[1] * vp_zoom)
+            img = transformed_img if transformed_img.size == size else transformed_img.resize(size, Image.LANCZOS)
             buf = self._save_jpeg(img)
             scaled_img_id = self._img_store.post_image('fs', 'optical_image', buf)
-            rows.append((scaled_img_id, ds.id, zoom))
+            return scaled_img_id, ds.id, zoom
 
-        for row in self._db.select(SEL_OPTICAL_IMAGE, params=(ds.id,)):
-            self._img_store.delete_image_by_id('fs', 'optical_image', row[0])
-        self._db.alter(DEL_OPTICAL_IMAGE, params=(ds.id,))
+        # resizing and jpeg encoding release the GIL, posting is network bound
+        with ThreadPoolExecutor(max_workers=len(zoom_levels)) as executor:
+            return list(executor.map(post_zoom_image, zoom_levels))
+
+    def _add_zoom_optical_images(self, ds, rows):
+        """ Returns ids of the replaced zoomed optical images """
+        old_img_ids = [row[0] for row in self._db.select(DEL_OPTICAL_IMAGE_RETURNING_ID, params=(ds.id,))]
         self._db.insert(INS_OPTICAL_IMAGE, rows=rows)
+        return old_img_ids
 
-    def _add_thumbnail_optical_image(self, ds, img_id, transform):
+    def _add_thumbnail_optical_image(self, ds, transformed_img):
         size = 200, 200
         self._db.alter(UPD_DATASET_THUMB_OPTICAL_IMAGE, params=(None, ds.id,))
-        dims = self._annotation_image_shape(ds)
-        optical_img = self._img_store.get_image_by_id('fs', 'raw_optical_image', img_id)
-        img = self._transform_scan(optical_img, transform, dims, zoom=1)
+        img = transformed_img.copy()
         img.thumbnail(size, Image.ANTIALIAS)
         buf = self._save_jpeg(img)
         img_thumb_id = self._img_store.post_image('fs', 'optical_image', buf)
@@ -267,9 +306,24 @@ class SMapiDatasetManager(DatasetManager):
     def add_optical_image(self, ds, img_id, transform, zoom_levels=[1, 2, 4, 8], **kwargs):
         """ Generate scaled and transformed versions of the provided optical image + creates the thumbnail """
         self.logger.info('Adding optical image to "%s" dataset', ds.id)
-        self._add_raw_optical_image(ds, img_id, transform)
-        self._add_zoom_optical_images(ds, img_id, transform, zoom_levels)
-        self._add_thumbnail_optical_image(ds, img_id, transform)
+        dims = self._annotation_image_shape(ds)
+        # the perspective transform is only applied once, at the largest zoom level,
+        # the other zoom levels and the thumbnail are downscaled from it
+        transformed_img = self._transform_optical_image(img_id, transform, dims, max(zoom_levels, default=1))
+        zoom_rows = self._post_zoom_optical_images(ds, transformed_img, dims, zoom_levels)
+        try:
+            with self._db.transaction():
+                old_raw_img_id = self._add_raw_optical_image(ds, img_id, transform)
+                old_img_ids = self._add_zoom_optical_images(ds, zoom_rows)
+        except Exception:
+            # the rolled back rows were the only references to the just posted images
+            self._img_store.delete_images_by_ids('fs', 'optical_image', [row[0] for row in zoom_rows])
+            raise
+        # old images are deleted from the store only after the new ones are committed
+        if old_raw_img_id and old_raw_img_id != img_id:
+            self._img_store.delete_image_by_id('fs', 'raw_optical_image', old_raw_img_id)
+        self._img_store.delete_images_by_ids('fs', 'optical_image', old_img_ids)
+        self._add_thumbnail_optical_image(ds, transformed_img)
 
     def del_optical_image(self, ds, **kwargs):
         """ Deletes raw and zoomed optical images from DB and FS"""
@@ -279,10 +333,9 @@ class SMapiDatasetManager(DatasetManager):
             raw_img_id = row[0]
             if raw_img_id:
                 self._img_store.delete_image_by_id('fs', 'raw_optical_image', raw_img_id)
-        for row in self._db.select(SEL_OPTICAL_IMAGE, params=(ds.id,)):
-            self._img_store.delete_image_by_id('fs', 'optical_image', row[0])
-        for row in self._db.select(SEL_OPTICAL_IMAGE_THUMBNAIL, params=(ds.id,)):
-            self._img_store.delete_image_by_id('fs', 'optical_image', row[0])
+        img_ids = [row[0] for row in self._db.select(SEL_OPTICAL_IMAGE, params=(ds.id,))]
+        img_ids += [row[0] for row in self._db.select(SEL_OPTICAL_IMAGE_THUMBNAIL, params=(ds.id,)) if row[0]]
+        self._img_store.delete_images_by_ids('fs', 'optical_image', img_ids)
         self._db.alter(DEL_DATASET_RAW_OPTICAL_IMAGE, params=(ds.id,))
         self._db.alter(DEL_OPTICAL_IMAGE, params=(ds.id,))
         self._db.alter(UPD_DATASET_THUMB_OPTICAL_IMAGE, params=(None, ds.id,))
@@ -4,7 +4,9 @@
 
 .. moduleauthor:: Vitaly Kovalev <intscorpio@gmail.com>
 """
+from contextlib import contextmanager
 from functools import wraps
+from uuid import uuid4
 
 import psycopg2
 import psycopg2.extensions
@@ -13,6 +15,13 @@ psycopg2.extensions.register_type(psycopg2.extensions.UNICODEARRAY)
 import psycopg2.extras
 import logging
 
+try:
+    import orjson
+except ImportError:
+    pass
+else:
+    psycopg2.extras.register_default_json(globally=True, loads=orjson.loads)
+
 
 logger = logging.getLogger('engine')
 
@@ -30,10 +39,12 @@ def db_decor(func):
             res = func(self, *args, **kwargs)
         except Exception as e:
             # logger.error('SQL: %s,\nArgs: %s', args[0], str(args[1:])[:1000], exc_info=False)
-            self.conn.rollback()
+            if not self._in_transaction:
+                self.conn.rollback()
             raise Exception('SQL: {},\nArgs: {}\nError: {}'.format(args[0], str(args[1:])[:1000], e.args[0]))
         else:
-            self.conn.commit()
+            if not self._in_transaction:
+                self.conn.commit()
         finally:
             if self.curs:
                 self.curs.close()
@@ -58,11 +69,33 @@ class DB(object):
         if autocommit:
             self.conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
         self.curs = None
+        self._in_transaction = False
 
     def close(self):
         """ Close the connection to the database """
         self.conn.close()
 
+    @contextmanager
+    def transaction(self):
+        """ Run all queries inside the block in one transaction, committed when the block exits
+        and rolled back if it raises. Autocommit mode is switched off for the duration of the block,
+        so the block is atomic on autocommit connections too
+        """
+        assert not self._in_transaction, 'Nested transactions are not supported'
+        autocommit = self.conn.autocommit
+        self.conn.autocommit = False
+        self._in_transaction = True
+        try:
+            yield self
+        except Exception:
+            self.conn.rollback()
+            raise
+        else:
+            self.conn.commit()
+        finally:
+            self._in_transaction = False
+            self.conn.autocommit = autocommit
+
     def _select(self, sql, params=None):
         self.curs = self.conn.cursor()
         self.curs.execute(sql, params) if params else self.curs.execute(sql)
@@ -85,6 +118,43 @@ class DB(object):
         """
         return self._select(sql, params)
 
+    def select_iter(self, sql, params=None, itersize=1000):
+        """ Execute select query, streaming rows from a server-side cursor.
+        Outside of autocommit mode the cursor only lives in the current transaction, so the connection
+        must not be used for other queries until the generator is exhausted or closed
+
+        Args
+        ------------
+        sql : string
+            sql select query with %s placeholders
+        params :
+            query parameters for placeholders
+        itersize : int
+            number of rows fetched from the server at once
+        Returns
+        ------------
+        : generator
+            rows
+        """
+        logger.debug(sql[:1000])
+        curs = self.conn.cursor(name='sm_select_iter_{}'.format(uuid4().hex), withhold=self.conn.autocommit)
+        curs.itersize = itersize
+        finished = False
+        try:
+            curs.execute(sql, params)
+            yield from curs
+            finished = True
+        except Exception as e:
+            raise Exception('SQL: {},\nArgs: {}\nError: {}'.format(sql, str(params)[:1000], e.args[0]))
+        else:
+            if not self._in_transaction:
+                self.conn.commit()
+        finally:
+            curs.close()
+            # also covers the generator being closed before all rows were consumed
+            if not finished and not self._in_transaction:
+                self.conn.rollback()
+
     @db_decor
     def select_with_fields(self, sql, params):
         rows = self._select(sql, params)
@@ -123,6 +193,22 @@ class DB(object):
         self.curs = self.conn.cursor()
         self.curs.executemany(sql, rows)
 
+    @db_decor
+    def insert_many_values(self, sql, rows=None, page_size=1000):
+        """ Execute insert query sending multiple rows per statement
+
+        Args
+        ------------
+        sql : string
+            sql insert query in INSERT INTO TABLE (col,...) VALUES %s format
+        rows : list
+            list of tuples as table rows
+        page_size : int
+            max number of rows per statement
+        """
+        self.curs = self.conn.cursor()
+        psycopg2.extras.execute_values(self.curs, sql, rows, page_size=page_size)
+
     @db_decor
     def insert_return(self, sql, rows=None):
         """ Execute insert query
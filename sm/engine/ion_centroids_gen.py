@@ -2,9 +2,10 @@ import logging
 from pathlib import Path
 import boto3
 from botocore.exceptions import ClientError
-from itertools import product, repeat
+from itertools import product
 from pyspark.sql import SparkSession
 import pandas as pd
+import numpy as np
 
 from sm.engine.util import SMConfig, split_s3_path
 from sm.engine.isocalc_wrapper import IsocalcWrapper
@@ -69,23 +70,20 @@ class IonCentroidsGenerator(object):
             ion_i, sf, adduct = args
             mzs, ints = isocalc.ion_centroids(sf, adduct)
             if mzs is not None:
-                return zip(repeat(ion_i),
-                           range(0, len(mzs)),
-                           map(float, mzs),
-                           map(float, ints))
+                return [(ion_i, mzs, ints)]
             else:
                 return []
 
+        # the product of sorted unique lists is already sorted and unique, no need to sort all (sf, adduct) pairs
         ion_df = pd.DataFrame([(i, sf, adduct) for i, (sf, adduct) in
-                               enumerate(sorted(product(sfs, adducts)))],
+                               enumerate(product(sorted(set(sfs)), sorted(set(adducts))))],
                               columns=['ion_i', 'sf', 'adduct']).set_index('ion_i')
 
         ion_centroids_rdd = (self._sc.parallelize(ion_df.reset_index().values,
                                                   numSlices=self._iso_gen_part_n)
                              .flatMap(calc_centroids))
-        self.ion_centroids_df = (pd.DataFrame(data=ion_centroids_rdd.collect(),
-                                              columns=['ion_i', 'peak_i', 'mz', 'int'])
-                                 .sort_values(by='mz')
+        self.ion_centroids_df = (self._flatten_centroids(ion_centroids_rdd.collect())
+                                 .sort_values(by='mz', kind='mergesort')
                                  .set_index('ion_i'))
 
         self.ion_df = ion_df.loc[self.ion_centroids_df.index.unique()]
@@ -97,6 +95,23 @@ class IonCentroidsGenerator(object):
         #                          .sort(ion_centroids_df.mz.asc())
         #                          .coalesce(self._parquet_chunks_n))
 
+    @staticmethod
+    def _flatten_centroids(ion_centroids):
+        """ Convert per ion (ion_i, mzs, ints) records into a one row per peak dataframe
+        """
+        columns = ['ion_i', 'peak_i', 'mz', 'int']
+        if not ion_centroids:
+            return pd.DataFrame(columns=columns)
+
+        ion_ids, mzs, ints = zip(*ion_centroids)
+        peak_ns = np.fromiter(map(len, mzs), dtype=np.int64, count=len(mzs))
+        peak_offsets = np.repeat(np.cumsum(peak_ns) - peak_ns, peak_ns)
+        return pd.DataFrame({'ion_i': np.repeat(np.array(ion_ids, dtype=np.int64), peak_ns),
+                             'peak_i': np.arange(peak_offsets.shape[0]) - peak_offsets,
+                             'mz': np.concatenate(mzs).astype(np.float64),
+                             'int': np.concatenate(ints).astype(np.float64)},
+                            columns=columns)
+
     def save(self):
         """ Save isotopic peaks
         """
@@ -1,4 +1,7 @@
-from collections import OrderedDict
+from pathlib import Path
+import os
+import pickle
+import tempfile
 import pandas as pd
 import logging
 import requests
@@ -8,33 +11,58 @@ from sm.engine.util import SMConfig
 
 logger = logging.getLogger('engine')
 
-SF_INS = 'INSERT INTO sum_formula (db_id, sf) values (%s, %s)'
+SF_INS = 'INSERT INTO sum_formula (db_id, sf) VALUES %s'
 SF_COUNT = 'SELECT count(*) FROM sum_formula WHERE db_id = %s'
 SF_SELECT = 'SELECT sf FROM sum_formula WHERE db_id = %s'
 
 
 class MolDBServiceWrapper(object):
+    """ Molecular database service client.
+        All instances share one keep-alive session. Lookups of a specific database version (by id or
+        by name and version) are cached, callers must not modify the returned objects.
+        Name-only lookups resolve the latest version and are never cached.
+    """
+    _session = requests.Session()
+    _cache = {}
+    _cache_max_size = 256
+
     def __init__(self, service_url):
         self._service_url = service_url
-        self._session = requests.Session()
 
-    def _fetch(self, url):
-        r = self._session.get(url)
+    @classmethod
+    def _fetch(cls, url):
+        r = cls._session.get(url)
         r.raise_for_status()
         return r.json()['data']
 
+    @classmethod
+    def _fetch_cached(cls, url):
+        data = cls._cache.get(url)
+        if data is None:
+            data = cls._fetch(url)
+            if data:  # don't cache misses, the database may be published later
+                if len(cls._cache) >= cls._cache_max_size:
+                    cls._cache.clear()
+                cls._cache[url] = data
+        return data
+
     def fetch_all_dbs(self):
         url = '{}/databases'.format(self._service_url)
         return self._fetch(url)
 
     def find_db_by_id(self, id):
         url = '{}/databases/{}'.format(self._service_url, id)
-        return self._fetch(url)
+        return self._fetch_cached(url)
+
+    def find_dbs_by_ids(self, ids):
+        url = '{}/databases?ids={}'.format(self._service_url, ','.join(map(str, sorted(ids))))
+        return self._fetch_cached(url)
 
     def find_db_by_name_version(self, name, version=None):
         url = '{}/databases?name={}'.format(self._service_url, name)
         if version:
             url += '&version={}'.format(version)
+            return self._fetch_cached(url)
         return self._fetch(url)
 
     def fetch_db_sfs(self, db_id):
@@ -73,6 +101,7 @@ class MolecularDB(object):
         sm_config = SMConfig.get_conf()
         self._mol_db_service = mol_db_service or MolDBServiceWrapper(sm_config['services']['mol_db'])
         self._db = db
+        self._sfs_cache_dir = Path(sm_config['fs']['base_path']).joinpath('mol_db_cache')
 
         if id is not None:
             data = self._mol_db_service.find_db_by_id(id)
@@ -124,13 +153,48 @@ class MolecularDB(object):
         """
         return pd.DataFrame(self._mol_db_service.fetch_molecules(self.id, sf=sf))
 
+    def _sfs_cache_path(self, sf_n):
+        return self._sfs_cache_dir.joinpath('sfs_{}_{}.pkl'.format(self._id, sf_n))
+
+    def _load_cached_sfs(self, sf_n):
+        cache_path = self._sfs_cache_path(sf_n)
+        try:
+            with cache_path.open('rb') as f:
+                return pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, EOFError, pickle.UnpicklingError) as e:
+            logger.warning('Failed to load cached formulas of %s molecular database: %s', self, e)
+            return None
+
+    def _cache_sfs(self, sfs):
+        # write to a temp file and rename it, so that a failed or concurrent write never leaves a partial file
+        tmp_path = None
+        try:
+            self._sfs_cache_dir.mkdir(parents=True, exist_ok=True)
+            with tempfile.NamedTemporaryFile(dir=str(self._sfs_cache_dir), suffix='.tmp', delete=False) as f:
+                tmp_path = f.name
+                pickle.dump(sfs, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, str(self._sfs_cache_path(len(sfs))))
+        except OSError as e:
+            logger.warning('Failed to cache formulas of %s molecular database: %s', self, e)
+            if tmp_path and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
     @property
     def sfs(self):
-        """ Total list of formulas """
+        """ Total list of formulas.
+            Formulas of a database never change, so they are cached on disk keyed by database id and formula count
+        """
         if not self._sfs:
-            if self._db.select_one(SF_COUNT, params=(self._id,))[0] == 0:
+            sf_n = self._db.select_one(SF_COUNT, params=(self._id,))[0]
+            if sf_n == 0:
                 sfs = self._mol_db_service.fetch_db_sfs(self.id)
                 rows = [(self._id, sf) for sf in sfs]
-                self._db.insert(SF_INS, rows)
-            self._sfs = [row[0] for row in self._db.select(SF_SELECT, params=(self._id,))]
+                self._db.insert_many_values(SF_INS, rows)
+            else:
+                self._sfs = self._load_cached_sfs(sf_n)
+            if not self._sfs:
+                self._sfs = [row[0] for row in self._db.select(SF_SELECT, params=(self._id,))]
+                self._cache_sfs(self._sfs)
         return self._sfs
@@ -1,6 +1,5 @@
 import sys
 from collections import defaultdict
-import pandas as pd
 import numpy as np
 from scipy.sparse import coo_matrix
 import logging
@@ -74,10 +73,22 @@ def _segment_spectrum(sp, mz_buckets):
         yield s_i, (sp_id, mzs[smask], ints[smask])
 
 
-def _sp_df_gen(sp_it, sp_indexes):
-    for sp_id, mzs, intensities in sp_it:
-        for mz, ints in zip(mzs, intensities):
-            yield sp_indexes[sp_id], mz, ints
+def _flatten_spectra(sp_it, sp_indexes):
+    """ Concatenate spectra into flat pixel index, mz and intensity arrays sorted by mz """
+    sp_ids, mzs, ints = [], [], []
+    for sp_id, sp_mzs, sp_ints in sp_it:
+        sp_ids.append(sp_id)
+        mzs.append(sp_mzs)
+        ints.append(sp_ints)
+    if not sp_ids:
+        return np.array([], dtype=int), np.array([]), np.array([])
+
+    peak_ns = np.fromiter(map(len, mzs), dtype=np.int64, count=len(mzs))
+    idx = np.repeat(np.asarray(sp_indexes)[sp_ids], peak_ns)
+    mzs = np.concatenate(mzs)
+    ints = np.concatenate(ints)
+    order = np.argsort(mzs, kind='mergesort')
+    return idx[order], mzs[order], ints[order]
 
 
 # def _create_lower_upper_mz_bounds(sf_peak_df, ppm):
@@ -94,26 +105,24 @@ def _sp_df_gen(sp_it, sp_indexes):
 
 def _gen_iso_images(spectra_it, sp_indexes, centr_df, nrows, ncols, ppm, min_px=1):
     if len(centr_df) > 0:
-        # a bit slower than using pure numpy arrays but much shorter
-        # may leak memory because of https://github.com/pydata/pandas/issues/2659 or smth else
-        sp_df = pd.DataFrame(_sp_df_gen(spectra_it, sp_indexes),
-                             columns=['idx', 'mz', 'ints']).sort_values(by='mz')
+        sp_idx, sp_mzs, sp_ints = _flatten_spectra(spectra_it, sp_indexes)
+        if sp_mzs.shape[0] == 0:
+            return
 
         # -1, + 1 are needed to extend sf_peak_mz range so that it covers 100% of spectra
         # sf_peak_df = sf_peak_df[(sf_peak_df.mz >= sp_df.mz.min()-1) & (sf_peak_df.mz <= sp_df.mz.max()+1)]
         # lower, upper = _create_lower_upper_mz_bounds(sf_peak_df, ppm)
-        centr_df = centr_df[(centr_df.mz >= sp_df.mz.min() - 1) &
-                            (centr_df.mz <= sp_df.mz.max() + 1)]
-        lower = centr_df.mz.map(lambda mz: mz - mz * ppm * 1e-6)
-        upper = centr_df.mz.map(lambda mz: mz + mz * ppm * 1e-6)
-        lower_idx = np.searchsorted(sp_df.mz, lower, 'l')
-        upper_idx = np.searchsorted(sp_df.mz, upper, 'r')
+        centr_df = centr_df[(centr_df.mz >= np.nanmin(sp_mzs) - 1) &
+                            (centr_df.mz <= np.nanmax(sp_mzs) + 1)]
+        centr_mzs = centr_df.mz.values
+        lower_idx = np.searchsorted(sp_mzs, centr_mzs - centr_mzs * ppm * 1e-6, 'left')
+        upper_idx = np.searchsorted(sp_mzs, centr_mzs + centr_mzs * ppm * 1e-6, 'right')
 
         for i, (l, u) in enumerate(zip(lower_idx, upper_idx)):
             if u - l >= min_px:
-                data = sp_df.ints[l:u].values
+                data = sp_ints[l:u]
                 if data.shape[0] > 0:
-                    idx = sp_df.idx[l:u].values
+                    idx = sp_idx[l:u]
                     row_inds = idx / ncols
                     col_inds = idx % ncols
                     m = coo_matrix((data, (row_inds, col_inds)), shape=(nrows, ncols))
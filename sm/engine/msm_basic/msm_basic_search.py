@@ -41,8 +41,7 @@ class MSMBasicSearch(SearchAlgorithm):
         return ion_metrics_fdr_df, ion_images
 
     def calc_metrics(self, sf_images, ion_centroids_df):
-        ion_centr_ints = (ion_centroids_df.reset_index().groupby(['ion_i'])
-                          .apply(lambda df: df.int.tolist()).to_dict())
+        ion_centr_ints = ion_centroids_df.int.groupby(level='ion_i').apply(list).to_dict()
         all_sf_metrics_df = sf_image_metrics(sf_images=sf_images, metrics=self.metrics, ds=self._ds,
                                              ds_reader=self._ds_reader, ion_centr_ints=ion_centr_ints, sc=self._sc)
         return all_sf_metrics_df
@@ -7,6 +7,8 @@ import requests
 import numpy as np
 from requests.adapters import HTTPAdapter
 
+logger = logging.getLogger('engine')
+
 
 class ImageStoreServiceWrapper(object):
 
@@ -14,6 +16,7 @@ class ImageStoreServiceWrapper(object):
         self._img_service_url = img_service_url
         self._session = requests.Session()
         self._session.mount(self._img_service_url, HTTPAdapter(max_retries=5))
+        self._batch_delete_supported = True
 
     def _format_url(self, storage_type, img_type, method='', img_id=''):
         assert storage_type, 'Wrong storage_type: %s' % storage_type
@@ -54,6 +57,37 @@ class ImageStoreServiceWrapper(object):
         url = self._format_url(storage_type=storage_type, img_type=img_type, method='delete', img_id=img_id)
         self.delete_image(url)
 
+    def delete_images_by_ids(self, storage_type, img_type, img_ids):
+        """ Delete multiple images with a single POST {storage_type}/{img_type}s/delete_batch request.
+        Image store versions without the batch endpoint don't respond with 202,
+        in which case the images are deleted one by one. After a 404 or 405 response
+        batch deletion is not attempted again by this wrapper
+
+        Args
+        ---
+        storage_type: str
+            db | fs
+        img_type: str
+            iso_image | optical_image | raw_optical_image
+        img_ids: list
+            ids of the images to delete
+        """
+        if not img_ids:
+            return
+        if self._batch_delete_supported:
+            url = self._format_url(storage_type=storage_type, img_type=img_type, method='delete_batch').rstrip('/')
+            r = self._session.post(url, json={'ids': list(img_ids)})
+            if r.status_code == 202:
+                return
+            if r.status_code in (404, 405):
+                logger.info('Image store does not support batch delete: %s. Deleting images one by one', url)
+                self._batch_delete_supported = False
+            else:
+                logger.warning('Batch delete failed with status %s: %s. Deleting %s images one by one',
+                               r.status_code, url, len(img_ids))
+        for img_id in img_ids:
+            self.delete_image_by_id(storage_type, img_type, img_id)
+
     def __str__(self):
         return self._img_service_url
 
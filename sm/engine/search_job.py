@@ -199,7 +199,7 @@ class SearchJob(object):
             self._save_data_from_raw_ms_file()
             self._img_store.storage_type = self._ds.get_ion_img_storage_type(self._db)
 
-            ds.set_status(self._db, self._es, self._status_queue, DatasetStatus.STARTED)
+            self._es.sync_dataset(ds.id)  # acquisition geometry has been saved
 
             logger.info('Dataset config:\n%s', pformat(self._ds.config))
 
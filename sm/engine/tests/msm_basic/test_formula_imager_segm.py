@@ -1,7 +1,9 @@
+import numpy as np
+import pandas as pd
 from scipy.sparse import coo_matrix
 
 from sm.engine.tests.util import pysparkling_context as spark_context
-from sm.engine.msm_basic.formula_imager_segm import gen_iso_sf_images
+from sm.engine.msm_basic.formula_imager_segm import gen_iso_sf_images, _gen_iso_images
 
 
 def test_gen_iso_sf_images(spark_context):
@@ -24,3 +26,17 @@ def test_gen_iso_sf_images(spark_context):
                 assert m is None
             else:
                 assert (m.toarray() == em.toarray()).all()
+
+
+def test_gen_iso_images():
+    spectra = [(0, np.array([100., 200.]), np.array([1., 2.])),
+               (1, np.array([100.0001, 300.]), np.array([3., 4.]))]
+    centr_df = pd.DataFrame({'ion_i': [5, 5, 6],
+                             'peak_i': [0, 1, 0],
+                             'mz': [100., 200., 300.]}).set_index('ion_i')
+
+    iso_images = list(_gen_iso_images(iter(spectra), np.array([0, 1]), centr_df,
+                                      nrows=1, ncols=2, ppm=3))
+
+    assert [(ion_i, peak_i) for ion_i, (peak_i, _) in iso_images] == [(5, 0), (5, 1), (6, 0)]
+    assert [m.toarray().tolist() for _, (_, m) in iso_images] == [[[1., 3.]], [[2., 0.]], [[0., 4.]]]
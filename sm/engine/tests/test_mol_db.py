@@ -1,9 +1,116 @@
-from sm.engine.mol_db import MolecularDB
+import pickle
+from pathlib import Path
+from sm.engine.mol_db import MolecularDB, MolDBServiceWrapper, SF_INS, SF_SELECT
 from sm.engine.tests.util import mol_db, sm_config, ds_config
 import pandas as pd
 import numpy.testing as npt
+import pytest
 from unittest.mock import MagicMock, patch
 
+
+@pytest.fixture()
+def mol_db_service():
+    MolDBServiceWrapper._cache.clear()
+    with patch.object(MolDBServiceWrapper, '_session') as session:
+        session.get.return_value.json.return_value = {'data': {'id': 1, 'name': 'HMDB', 'version': '2016'}}
+        yield MolDBServiceWrapper('http://mol-db'), session
+    MolDBServiceWrapper._cache.clear()
+
+
+def test_find_db_by_id_is_cached(mol_db_service):
+    service, session = mol_db_service
+
+    assert service.find_db_by_id(1) == service.find_db_by_id(1)
+
+    session.get.assert_called_once_with('http://mol-db/databases/1')
+
+
+def test_find_dbs_by_ids_sorts_ids_and_is_cached(mol_db_service):
+    service, session = mol_db_service
+    session.get.return_value.json.return_value = {'data': [{'id': 1, 'name': 'HMDB'}, {'id': 2, 'name': 'ChEBI'}]}
+
+    assert service.find_dbs_by_ids({2, 1}) == service.find_dbs_by_ids([1, 2])
+
+    session.get.assert_called_once_with('http://mol-db/databases?ids=1,2')
+
+
+def test_find_db_by_name_version_cached_only_for_explicit_version(mol_db_service):
+    service, session = mol_db_service
+
+    service.find_db_by_name_version('HMDB', '2016')
+    service.find_db_by_name_version('HMDB', '2016')
+    assert session.get.call_count == 1
+
+    service.find_db_by_name_version('HMDB')
+    service.find_db_by_name_version('HMDB')
+    assert session.get.call_count == 3
+
+
+def test_fetch_cached_does_not_cache_misses(mol_db_service):
+    service, session = mol_db_service
+    session.get.return_value.json.return_value = {'data': []}
+
+    service.find_db_by_name_version('HMDB', '2018')
+    service.find_db_by_name_version('HMDB', '2018')
+
+    assert session.get.call_count == 2
+
+
+def test_fetch_db_sfs_is_not_cached(mol_db_service):
+    service, session = mol_db_service
+
+    service.fetch_db_sfs(1)
+    service.fetch_db_sfs(1)
+
+    assert session.get.call_count == 2
+
+
+def test_sfs_cache_hit_skips_select(mol_db, tmpdir):
+    mol_db._sfs_cache_dir = Path(str(tmpdir))
+    mol_db._db.select_one.return_value = (2,)
+    with open(str(tmpdir.join('sfs_1_2.pkl')), 'wb') as f:
+        pickle.dump(['H2O', 'CO2'], f)
+
+    assert mol_db.sfs == ['H2O', 'CO2']
+    mol_db._db.select.assert_not_called()
+
+
+def test_sfs_cache_miss_selects_and_writes_cache(mol_db, tmpdir):
+    mol_db._sfs_cache_dir = Path(str(tmpdir))
+    mol_db._db.select_one.return_value = (2,)
+    mol_db._db.select.return_value = [('H2O',), ('CO2',)]
+
+    assert mol_db.sfs == ['H2O', 'CO2']
+    mol_db._db.select.assert_called_once_with(SF_SELECT, params=(1,))
+    with open(str(tmpdir.join('sfs_1_2.pkl')), 'rb') as f:
+        assert pickle.load(f) == ['H2O', 'CO2']
+    assert tmpdir.listdir() == [tmpdir.join('sfs_1_2.pkl')]
+
+
+def test_sfs_corrupt_cache_falls_back_to_select(mol_db, tmpdir):
+    mol_db._sfs_cache_dir = Path(str(tmpdir))
+    mol_db._db.select_one.return_value = (2,)
+    mol_db._db.select.return_value = [('H2O',), ('CO2',)]
+    with open(str(tmpdir.join('sfs_1_2.pkl')), 'wb') as f:
+        f.write(pickle.dumps(['H2O', 'CO2'])[:5])
+
+    assert mol_db.sfs == ['H2O', 'CO2']
+    mol_db._db.select.assert_called_once_with(SF_SELECT, params=(1,))
+
+
+def test_sfs_no_stored_formulas_inserts_fetched_and_writes_cache(mol_db, tmpdir):
+    mol_db._sfs_cache_dir = Path(str(tmpdir))
+    mol_db._db.select_one.return_value = (0,)
+    mol_db._mol_db_service.fetch_db_sfs.return_value = ['H2O', 'CO2']
+    mol_db._db.select.return_value = [('H2O',), ('CO2',)]
+
+    assert mol_db.sfs == ['H2O', 'CO2']
+    mol_db._db.insert_many_values.assert_called_once_with(SF_INS, [(1, 'H2O'), (1, 'CO2')])
+    mol_db._db.select.assert_called_once_with(SF_SELECT, params=(1,))
+    with open(str(tmpdir.join('sfs_1_2.pkl')), 'rb') as f:
+        assert pickle.load(f) == ['H2O', 'CO2']
+
+
 # def test_peak_generator(mol_db):
 #     expected_peak_df = pd.DataFrame(dict(
 #         sf_id=[1, 1, 1, 2, 3, 3],
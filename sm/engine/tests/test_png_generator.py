@@ -1,8 +1,9 @@
+from unittest.mock import MagicMock, call
 import numpy as np
 from numpy.testing import assert_almost_equal, assert_equal
 from png import Reader
 
-from sm.engine.png_generator import PngGenerator
+from sm.engine.png_generator import PngGenerator, ImageStoreServiceWrapper
 
 
 def test_png_gen_greyscale_works():
@@ -20,3 +21,41 @@ def test_png_gen_greyscale_works():
 
     grey_shape = img_data.shape + (2,)
     assert_almost_equal(np.array(list(pixels)).reshape(grey_shape)[:,:,0], norm_img_data, decimal=4)
+
+
+def test_delete_images_by_ids_posts_single_batch_request():
+    img_store = ImageStoreServiceWrapper('http://img-store')
+    img_store._session = MagicMock()
+    img_store._session.post.return_value.status_code = 202
+
+    img_store.delete_images_by_ids('fs', 'iso_image', ['id1', 'id2'])
+
+    img_store._session.post.assert_called_once_with('http://img-store/fs/iso_images/delete_batch',
+                                                    json={'ids': ['id1', 'id2']})
+    img_store._session.delete.assert_not_called()
+
+
+def test_delete_images_by_ids_falls_back_to_single_deletes():
+    img_store = ImageStoreServiceWrapper('http://img-store')
+    img_store._session = MagicMock()
+    img_store._session.post.return_value.status_code = 404
+    img_store._session.delete.return_value.status_code = 202
+
+    img_store.delete_images_by_ids('fs', 'iso_image', ['id1', 'id2'])
+
+    img_store._session.delete.assert_has_calls([call('http://img-store/fs/iso_images/delete/id1'),
+                                                call('http://img-store/fs/iso_images/delete/id2')])
+
+
+def test_delete_images_by_ids_no_batch_endpoint_skips_batch_request_next_time():
+    img_store = ImageStoreServiceWrapper('http://img-store')
+    img_store._session = MagicMock()
+    img_store._session.post.return_value.status_code = 404
+    img_store._session.delete.return_value.status_code = 202
+
+    img_store.delete_images_by_ids('fs', 'iso_image', ['id1'])
+    img_store.delete_images_by_ids('fs', 'iso_image', ['id2'])
+
+    img_store._session.post.assert_called_once()
+    img_store._session.delete.assert_has_calls([call('http://img-store/fs/iso_images/delete/id1'),
+                                                call('http://img-store/fs/iso_images/delete/id2')])
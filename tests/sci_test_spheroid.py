@@ -131,6 +131,9 @@ class SciTester(object):
             def delete_image_by_id(self, *args):
                 return None
 
+            def delete_images_by_ids(self, *args):
+                return None
+
         return ImageStoreMock()
 
     def run_search(self, mock_img_store=False):
@@ -3,7 +3,9 @@ import json
 from unittest.mock import MagicMock
 from pytest import fixture
 
+import numpy as np
 from sm.engine import DatasetStatus, Dataset, DB, ESExporter, QueuePublisher
+from sm.engine.dataset import json_dumps
 from sm.engine.queue import SM_DS_STATUS
 from sm.engine.tests.util import pysparkling_context, sm_config, ds_config, test_db
 
@@ -69,6 +71,22 @@ def test_dataset_update_status_works(fill_db, sm_config, ds_config):
     status_queue_mock.publish.assert_called_once_with({'ds_id': ds_id, 'status': DatasetStatus.FINISHED})
 
 
+def test_dataset_update_status_same_status_does_nothing(fill_db, sm_config, ds_config):
+    db = DB(sm_config['db'])
+    es_mock = MagicMock(spec=ESExporter)
+    status_queue_mock = MagicMock(spec=QueuePublisher)
+
+    upload_dt = datetime.now()
+    ds_id = '2000-01-01'
+    ds = Dataset(ds_id, 'ds_name', 'input_path', upload_dt, {}, ds_config, DatasetStatus.FINISHED,
+                 mol_dbs=['HMDB'], adducts=['+H'])
+
+    ds.set_status(db, es_mock, status_queue_mock, DatasetStatus.FINISHED)
+
+    es_mock.sync_dataset.assert_not_called()
+    status_queue_mock.publish.assert_not_called()
+
+
 def test_dataset_to_queue_message_works():
     upload_dt = datetime.now()
     ds_id = '2000-01-01'
@@ -80,3 +98,9 @@ def test_dataset_to_queue_message_works():
 
     assert {'ds_id': ds_id, 'ds_name': 'ds_name', 'input_path': 'input_path',
             'user_email': 'user@example.com'} == msg
+
+
+def test_json_dumps_handles_numpy_values_and_non_str_keys():
+    doc = {'mz': np.float64(100.5), 1: [1, 2]}
+
+    assert json.loads(json_dumps(doc)) == {'mz': 100.5, '1': [1, 2]}
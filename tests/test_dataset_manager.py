@@ -3,6 +3,8 @@ import json
 from datetime import datetime
 from copy import deepcopy
 import pytest
+import numpy as np
+from numpy.testing import assert_almost_equal
 from PIL import Image
 
 from sm.engine import DB, ESExporter, QueuePublisher
@@ -115,6 +117,36 @@ class TestSMapiDatasetManager:
 
         action_queue_mock.assert_not_called()
 
+    def test_update_ds__nothing_changed__no_message(self, fill_db, sm_config, ds_config):
+        action_queue_mock = MagicMock(spec=QueuePublisher)
+        ds_man = create_ds_man(sm_config, action_queue=action_queue_mock, sm_api=True)
+
+        ds_id = '2000-01-01'
+        ds = create_ds(ds_id=ds_id, upload_dt=datetime(2000, 1, 1), metadata={"meta": "data"},
+                       ds_config=ds_config, status=DatasetStatus.FINISHED)
+
+        ds_man.update(ds)
+
+        action_queue_mock.publish.assert_not_called()
+
+    @pytest.mark.parametrize('stored_status', [DatasetStatus.INDEXING, DatasetStatus.FAILED])
+    def test_update_ds__nothing_changed_not_finished__sends_message(self, fill_db, sm_config, ds_config,
+                                                                    stored_status):
+        db = DB(sm_config['db'])
+        ds_id = '2000-01-01'
+        db.alter('UPDATE dataset SET status = %s WHERE id = %s', params=(stored_status, ds_id))
+        action_queue_mock = MagicMock(spec=QueuePublisher)
+        ds_man = create_ds_man(sm_config, db=db, action_queue=action_queue_mock, sm_api=True)
+
+        ds = create_ds(ds_id=ds_id, upload_dt=datetime(2000, 1, 1), metadata={"meta": "data"},
+                       ds_config=ds_config, status=stored_status)
+
+        ds_man.update(ds)
+
+        msg = {'ds_id': ds_id, 'ds_name': 'ds_name', 'input_path': 'input_path',
+               'action': DatasetAction.UPDATE}
+        action_queue_mock.publish.assert_has_calls([call(msg, DatasetActionPriority.HIGH)])
+
     def test_add_ds__new_mol_db(self, fill_db, sm_config, ds_config):
         action_queue_mock = MagicMock(spec=QueuePublisher)
         ds_man = create_ds_man(sm_config, action_queue=action_queue_mock, sm_api=True)
@@ -134,7 +166,9 @@ class TestSMapiDatasetManager:
         action_queue_mock = MagicMock(spec=QueuePublisher)
         es_mock = MagicMock(spec=ESExporter)
         img_store_mock = MagicMock(ImageStoreServiceWrapper)
-        img_store_mock.post_image.side_effect = ['opt_img_id1', 'opt_img_id2', 'opt_img_id3', 'thumbnail_id']
+        # zoomed images are posted concurrently, so derive ids from the posted image width
+        img_store_mock.post_image.side_effect = lambda storage_type, img_type, fp: \
+            'opt_img_{}'.format(Image.open(fp).size[0])
         img_store_mock.get_image_by_id.return_value = Image.new('RGB', (100, 100))
 
         ds_man = create_ds_man(sm_config=sm_config, db=db, es=es_mock,
@@ -148,11 +182,76 @@ class TestSMapiDatasetManager:
         raw_img_id = 'raw_opt_img_id'
         ds_man.add_optical_image(ds, raw_img_id, [[1, 0, 0], [0, 1, 0], [0, 0, 1]],
                                  zoom_levels=zoom_levels)
+        # 100x100 annotation image is scaled 5x to fit the 1000x500 viewport at zoom = 1
         assert db.select('SELECT * FROM optical_image') == [
-                ('opt_img_id{}'.format(i + 1), ds.id, zoom)
-                for i, zoom in enumerate(zoom_levels)]
+                ('opt_img_{}'.format(500 * zoom), ds.id, zoom)
+                for zoom in zoom_levels]
         assert db.select('SELECT optical_image FROM dataset where id = %s', params=(ds_id,)) == [(raw_img_id,)]
-        assert db.select('SELECT thumbnail FROM dataset where id = %s', params=(ds_id,)) == [('thumbnail_id',)]
+        assert db.select('SELECT thumbnail FROM dataset where id = %s', params=(ds_id,)) == [('opt_img_200',)]
+        img_store_mock.get_image_by_id.assert_called_once_with('fs', 'raw_optical_image', raw_img_id)
+
+    def test_add_optical_image__db_error__rolls_back(self, fill_db, sm_config, ds_config):
+        db = DB(sm_config['db'])
+        ds_id = '2000-01-01'
+        db.alter('UPDATE dataset SET optical_image = %s WHERE id = %s', params=('old_raw_img_id', ds_id))
+        db.insert('INSERT INTO optical_image (id, ds_id, zoom) VALUES (%s, %s, %s)',
+                  rows=[('old_opt_img_id', ds_id, 1)])
+
+        img_store_mock = MagicMock(ImageStoreServiceWrapper)
+        img_store_mock.post_image.return_value = 'opt_img_id'
+        img_store_mock.get_image_by_id.return_value = Image.new('RGB', (100, 100))
+
+        ds_man = create_ds_man(sm_config=sm_config, db=db, img_store=img_store_mock, sm_api=True)
+        ds_man._annotation_image_shape = MagicMock(return_value=(100, 100))
+        add_zoom_optical_images = ds_man._add_zoom_optical_images
+
+        def add_zoom_optical_images_fail(*args):
+            add_zoom_optical_images(*args)
+            raise Exception('DB error')
+        ds_man._add_zoom_optical_images = add_zoom_optical_images_fail
+
+        ds = create_ds(ds_id=ds_id, ds_config=ds_config)
+        with pytest.raises(Exception):
+            ds_man.add_optical_image(ds, 'raw_opt_img_id', [[1, 0, 0], [0, 1, 0], [0, 0, 1]], zoom_levels=[1])
+
+        assert db.select('SELECT * FROM optical_image') == [('old_opt_img_id', ds_id, 1)]
+        assert db.select('SELECT optical_image FROM dataset where id = %s', params=(ds_id,)) == [('old_raw_img_id',)]
+        img_store_mock.delete_image_by_id.assert_not_called()
+        img_store_mock.delete_images_by_ids.assert_called_once_with('fs', 'optical_image', ['opt_img_id'])
+
+    def test_transform_scan__matches_normalized_matrix(self, sm_config):
+        ds_man = create_ds_man(sm_config, db=MagicMock(spec=DB), sm_api=True)
+        scan = MagicMock(spec=Image.Image)
+        transform = [[2.0, 0.3, 5.0], [-0.4, 1.5, 7.0], [0.01, 0.02, 2.0]]
+        dims, zoom = (100, 50), 2
+
+        ds_man._transform_scan(scan, transform, dims, zoom)
+
+        vp_zoom = ds_man._viewport_zoom(dims, zoom)
+        assert vp_zoom > 1
+        t = np.array(transform) / transform[2][2]
+        t[:, :2] /= vp_zoom
+        (size, method, coeffs, resample), _ = scan.transform.call_args
+        assert size == (dims[0] * vp_zoom, dims[1] * vp_zoom)
+        assert_almost_equal(coeffs, t.flat[:8])
+
+    def test_add_optical_image__no_zoom_levels(self, fill_db, sm_config, ds_config):
+        db = DB(sm_config['db'])
+        img_store_mock = MagicMock(ImageStoreServiceWrapper)
+        img_store_mock.post_image.side_effect = lambda storage_type, img_type, fp: \
+            'opt_img_{}'.format(Image.open(fp).size[0])
+        img_store_mock.get_image_by_id.return_value = Image.new('RGB', (100, 100))
+
+        ds_man = create_ds_man(sm_config=sm_config, db=db, img_store=img_store_mock, sm_api=True)
+        ds_man._annotation_image_shape = MagicMock(return_value=(100, 100))
+
+        ds_id = '2000-01-01'
+        ds = create_ds(ds_id=ds_id, ds_config=ds_config)
+
+        ds_man.add_optical_image(ds, 'raw_opt_img_id', [[1, 0, 0], [0, 1, 0], [0, 0, 1]], zoom_levels=[])
+
+        assert db.select('SELECT * FROM optical_image') == []
+        assert db.select('SELECT thumbnail FROM dataset where id = %s', params=(ds_id,)) == [('opt_img_200',)]
 
 
 class TestSMDaemonDatasetManager:
@@ -200,7 +299,7 @@ class TestSMDaemonDatasetManager:
 
             with patch('sm.engine.dataset_manager.MolDBServiceWrapper') as MolDBServiceWrapper:
                 moldb_service_wrapper_mock = MolDBServiceWrapper.return_value
-                moldb_service_wrapper_mock.find_db_by_id.return_value = {'name': 'HMDB-v4'}
+                moldb_service_wrapper_mock.find_dbs_by_ids.return_value = [{'id': 0, 'name': 'HMDB-v4'}]
 
                 ds_man.update(ds)
 
@@ -222,7 +321,23 @@ class TestSMDaemonDatasetManager:
         ds_man.delete(ds)
 
         ids = ['iso_image_{}_id'.format(id) for id in range(1, 3)]
-        img_store_service_mock.delete_image_by_id.assert_has_calls(
-            [call('fs', 'iso_image', ids[0]), call('fs', 'iso_image', ids[1])])
+        img_store_service_mock.delete_images_by_ids.assert_called_once_with('fs', 'iso_image', ids)
         es_mock.delete_ds.assert_called_with(ds_id)
         assert db.select_one('SELECT * FROM dataset WHERE id = %s', params=(ds_id,)) == []
+
+    def test_delete_ds__deletes_images_in_batches(self, fill_db, sm_config, ds_config):
+        db = DB(sm_config['db'])
+        img_store_service_mock = MagicMock(spec=ImageStoreServiceWrapper)
+        ds_man = create_ds_man(sm_config, db=db, es=MagicMock(spec=ESExporter), img_store=img_store_service_mock,
+                               action_queue=MagicMock(spec=QueuePublisher), sm_api=False)
+
+        ds = create_ds(ds_id='2000-01-01', ds_config=ds_config)
+
+        with patch('sm.engine.dataset_manager.DEL_IMG_BATCH_SIZE', 1):
+            ds_man.delete(ds)
+
+        img_store_service_mock.delete_images_by_ids.assert_has_calls([
+            call('fs', 'iso_image', ['iso_image_1_id']),
+            call('fs', 'iso_image', ['iso_image_2_id'])
+        ])
+        assert img_store_service_mock.delete_images_by_ids.call_count == 2
@@ -0,0 +1,51 @@
+import pytest
+import psycopg2.extensions
+
+from sm.engine.db import DB
+from sm.engine.tests.util import sm_config, test_db
+
+
+@pytest.mark.parametrize('autocommit', [False, True])
+def test_transaction_rolls_back_all_queries_on_error(test_db, sm_config, autocommit):
+    db = DB(sm_config['db'], autocommit=autocommit)
+    try:
+        db.alter('CREATE TABLE tx_test (id int, val text)')
+        db.insert('INSERT INTO tx_test (id, val) VALUES (%s, %s)', rows=[(1, 'old')])
+
+        with pytest.raises(ValueError):
+            with db.transaction():
+                db.alter('UPDATE tx_test SET val = %s WHERE id = %s', params=('new', 1))
+                db.insert('INSERT INTO tx_test (id, val) VALUES (%s, %s)', rows=[(2, 'new')])
+                raise ValueError()
+
+        assert db.select('SELECT id, val FROM tx_test') == [(1, 'old')]
+        assert db.conn.autocommit == autocommit
+    finally:
+        db.close()
+
+
+def test_transaction_commits_on_exit(test_db, sm_config):
+    db = DB(sm_config['db'])
+    other_db = DB(sm_config['db'])
+    try:
+        db.alter('CREATE TABLE tx_test (id int, val text)')
+        with db.transaction():
+            db.insert('INSERT INTO tx_test (id, val) VALUES (%s, %s)', rows=[(1, 'new')])
+            assert other_db.select('SELECT id, val FROM tx_test') == []
+
+        assert other_db.select('SELECT id, val FROM tx_test') == [(1, 'new')]
+    finally:
+        db.close()
+        other_db.close()
+
+
+def test_select_iter_closed_early_ends_transaction(test_db, sm_config):
+    db = DB(sm_config['db'])
+    try:
+        rows = db.select_iter('SELECT generate_series(1, 10)', itersize=2)
+        assert next(rows) == (1,)
+        rows.close()
+
+        assert db.conn.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_IDLE
+    finally:
+        db.close()
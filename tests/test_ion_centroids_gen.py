@@ -29,6 +29,17 @@ def test_generate_returns_valid_df(pyspark_context, sm_config, ds_config):
     assert centroids_gen.ion_df.shape == (2, 2)
 
 
+def test_generate_ignores_duplicate_formulas(pyspark_context, sm_config, ds_config):
+    isocalc = IsocalcWrapper(ds_config['isotope_generation'])
+    centroids_gen = IonCentroidsGenerator(sc=pyspark_context, moldb_name='HMDB', isocalc=isocalc)
+    centroids_gen._iso_gen_part_n = 1
+    centroids_gen.generate(isocalc=isocalc, sfs=['C3H6O7', 'C2H4O8', 'C3H6O7'], adducts=['+Na', '+Na'])
+
+    assert centroids_gen.ion_df.shape == (2, 2)
+    assert not centroids_gen.ion_df.duplicated().any()
+    assert centroids_gen.ion_df.sf.tolist() == ['C2H4O8', 'C3H6O7']
+
+
 def test_save_restore_works(pyspark_context, sm_config, ds_config):
     isocalc = IsocalcWrapper(ds_config['isotope_generation'])
     centr_gen = IonCentroidsGenerator(sc=pyspark_context, moldb_name='HMDB', isocalc=isocalc)